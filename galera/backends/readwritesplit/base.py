@@ -1,9 +1,11 @@
+import concurrent.futures
 import copy
+import functools
 import hashlib
 import logging
-import pprint
 import random
 import re
+import threading
 import time
 
 from django.db import DEFAULT_DB_ALIAS, DatabaseError
@@ -12,39 +14,140 @@ from django.utils.functional import cached_property
 
 LOGGER = logging.getLogger(__name__)
 
+# cursor attributes that do not change the state of a cursor and are not needed for transaction replay
+UNRECORDED_ATTRIBUTES = frozenset(('_executed', 'arraysize', 'connection'))
+
+# inserts returning the value of an auto field, used to make the value persistent when the history is replayed
+INSERT_RETURNING_RE = re.compile(r'^INSERT INTO `([^`]+)` \((.+)\) VALUES (.+) RETURNING `([^`]+)`.`([^`]+)`$')
+
+
+# longer queries are classified without the cache, so it can not keep large query strings alive
+SELECT_CACHE_MAX_LENGTH = 1024
+
+
+def _is_write_select(query):
+    return query.endswith(' FOR UPDATE') or ' INTO ' in query
+
+
+_is_write_select_cached = functools.lru_cache(maxsize=1024)(_is_write_select)
+
+
+def _is_write_query(query):
+    query = query.strip()
+    # anything but SELECT is decided by the first token, only SELECT needs to be scanned further
+    if not query.startswith('SELECT '):
+        return True
+    if len(query) > SELECT_CACHE_MAX_LENGTH:
+        return _is_write_select(query)
+    return _is_write_select_cached(query)
+
+
+def _backoff_sleep(previous=0.0, base_delay=0.01, cap=1.0):
+    # decorrelated jitter, the window grows with the previous wait so concurrent retries spread out over time
+    wait = min(cap, random.uniform(base_delay, (previous or base_delay) * 3))
+    time.sleep(wait)
+    return wait
+
+
+# checksums of the most common results, equal to the ones computed by _checksum
+CHECKSUM_NONE = hashlib.blake2b(b'None', digest_size=16).digest()
+CHECKSUM_EMPTY = hashlib.blake2b(b'()', digest_size=16).digest()
+
+
+def _checksum(value):
+    if value is None:
+        return CHECKSUM_NONE
+    if type(value) is tuple and not value:
+        return CHECKSUM_EMPTY
+    checksum = hashlib.blake2b(digest_size=16)
+    if isinstance(value, (list, tuple)) and value and isinstance(value[0], (list, tuple, dict)):
+        # hash result sets row by row instead of building a single string of the whole result
+        checksum.update(b'rows')
+        for row in value:
+            checksum.update(repr(row).encode('utf-8', 'surrogatepass'))
+            checksum.update(b'\n')
+    else:
+        checksum.update(repr(value).encode('utf-8', 'surrogatepass'))
+    return checksum.digest()
+
 
 class NodeState:
+    CACHE_TTL = 1.0
+    LATENCY_WEIGHT = 0.125
     RETRY_INTERVAL = 30
 
     def __init__(self, store=None):
         if store is None:
             store = dict()
         self.nodes = store
+        self.checked = dict()
+        self.latencies = dict()
+        # (online nodes, monotonic time), replaced as a whole so readers never see a half updated cache
+        self._cache = None
+        self._lock = threading.Lock()
 
     def add_nodes(self, nodes):
-        for node in nodes:
-            if node not in self.nodes:
-                self.nodes[node] = None
+        with self._lock:
+            for node in nodes:
+                if node not in self.nodes:
+                    self.nodes[node] = None
+                    self._cache = None
 
-    def mark_online(self, node):
+    def mark_online(self, node, latency=None):
         if node in self.nodes:
-            self.nodes[node] = None
+            with self._lock:
+                self.nodes[node] = None
+                self._cache = None
+                if latency is not None:
+                    # exponentially weighted moving average of the time needed to connect and check a node
+                    previous = self.latencies.get(node, latency)
+                    self.latencies[node] = previous + self.LATENCY_WEIGHT * (latency - previous)
 
     def mark_offline(self, node):
         if node in self.nodes:
-            self.nodes[node] = time.time()
+            with self._lock:
+                self.nodes[node] = time.time()
+                self.checked.pop(node, None)
+                self._cache = None
+
+    def mark_checked(self, node):
+        self.checked[node] = time.monotonic()
+
+    def is_checked(self, node, interval):
+        checked = self.checked.get(node)
+        return checked is not None and time.monotonic() - checked < interval
 
     def get_all_nodes(self):
         return tuple(self.nodes.keys())
 
     def get_online_nodes(self):
-        return tuple(x for x, y in self.nodes.items() if y is None or time.time() > y + self.RETRY_INTERVAL)
+        # the online set only changes on the scale of RETRY_INTERVAL, so it is cached for a short time
+        now = time.monotonic()
+        cache = self._cache
+        if cache is not None and now - cache[1] < self.CACHE_TTL:
+            return cache[0]
+        # rebuilt under the lock, so a node marked offline meanwhile cannot be cached as online
+        with self._lock:
+            cutoff = time.time() - self.RETRY_INTERVAL
+            online = tuple([x for x, y in self.nodes.items() if y is None or y < cutoff])
+            self._cache = (online, now)
+        return online
+
+    def count_online(self):
+        return len(self.get_online_nodes())
+
+    def shuffle_by_latency(self, nodes):
+        # weighted random order, faster nodes are more likely to come first and unmeasured nodes are tried early
+        return sorted(nodes, key=lambda x: random.random() ** (self.latencies.get(x, 0.0) + 0.001), reverse=True)
 
 
 NODE_STATE = NodeState()
 
 
 class CursorWrapper:
+    # a cursor is created for every query, slots keep it small and make attribute access cheaper
+    __slots__ = ('_backend', '_cursor', '_primary', '_history_entry_index')
+
     def __init__(self, backend):
         self._backend = backend
         self._cursor = None
@@ -60,29 +163,39 @@ class CursorWrapper:
                 self._cursor = self._backend.create_secondary_cursor()
         return self._cursor
 
-    def add_history(self, attr, args, kwargs, return_value):
-        if self._backend.failover_active and attr != '_executed':
-            if self._history_entry_index is None or len(self._backend.failover_history) == 0:
-                self._history_entry_index = len(self._backend.failover_history)
-                self._backend.failover_history.append([])
-            self._backend.failover_history[self._history_entry_index].append((
+    # description and rowcount are read for most queries, they do not need to be replayed and bypass __getattr__
+    @property
+    def description(self):
+        return self.cursor.description
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    def add_history(self, attr, args, kwargs, return_value, failover_active=None):
+        backend = self._backend
+        if failover_active is None:
+            failover_active = backend.failover_active
+        if failover_active:
+            if self._history_entry_index is None or len(backend.failover_history) == 0:
+                self._history_entry_index = len(backend.failover_history)
+                backend.failover_history.append([])
+            entry = backend.failover_history[self._history_entry_index]
+            entry.append((
                 attr,
                 args,
                 kwargs,
-                hashlib.sha1(pprint.pformat(return_value).encode()).hexdigest()
+                _checksum(return_value) if backend.failover_verify_checksum else None
             ))
-            self._backend.failover_history_size += 1
+            backend.failover_history_size += 1
 
             # store the insert id of an auto field, so it does not change when the history is replayed
-            if self._backend.failover_history[self._history_entry_index][-1][0] in ('fetchone', 'fetchall') \
-                    and self._backend.failover_history[self._history_entry_index][-2][0] == 'execute' \
-                    and self._backend.failover_history[self._history_entry_index][-2][1][0].startswith('INSERT '):
-                insert_entry = self._backend.failover_history[self._history_entry_index][-2]
+            if attr in ('fetchone', 'fetchall') \
+                    and entry[-2][0] == 'execute' \
+                    and entry[-2][1][0].startswith('INSERT '):
+                insert_entry = entry[-2]
                 insert_sql = insert_entry[1][0]
-                match = re.match(
-                    r'^INSERT INTO `([^`]+)` \((.+)\) VALUES (.+) RETURNING `([^`]+)`.`([^`]+)`$',
-                    insert_sql
-                )
+                match = INSERT_RETURNING_RE.match(insert_sql)
                 if match:
                     table_name, fields, values, auto_table, auto_field = match.groups()
                     values_new = values.replace('(%s, ', '(%s, %s, ')
@@ -93,58 +206,62 @@ class CursorWrapper:
                         f'RETURNING `{auto_table}`.`{auto_field}`'
                     )
                     if new_sql != insert_sql:
-                        kwargs = copy.deepcopy(insert_entry[2])
-                        kwargs['args'] = list(kwargs['args'])
-                        values_count = int(round(len(kwargs['args']) / len(return_value)))
+                        # bind values are immutable, copying the containers is sufficient
+                        kwargs = dict(insert_entry[2])
+                        args = list(kwargs['args'])
+                        values_count = int(round(len(args) / len(return_value)))
                         if len(return_value) == 1:
-                            kwargs['args'].insert(0, str(return_value[0]))
+                            args.insert(0, str(return_value[0]))
                         else:
                             for x in range(len(return_value)):
-                                kwargs['args'].insert(x * values_count + x, str(return_value[x][0]))
-                        kwargs['args'] = tuple(kwargs['args'])
-                        self._backend.failover_history[self._history_entry_index][-2] = (
+                                args.insert(x * values_count + x, str(return_value[x][0]))
+                        kwargs['args'] = tuple(args)
+                        entry[-2] = (
                             insert_entry[0],
                             (new_sql,),
                             kwargs,
                             insert_entry[3],
                         )
                     else:
-                        LOGGER.warning('SQL unchanged: %s' % insert_sql)
+                        LOGGER.warning('SQL unchanged: %s', insert_sql)
                 else:
-                    LOGGER.warning('No match: %s' % insert_sql)
+                    LOGGER.warning('No match: %s', insert_sql)
 
     def prepare(self, query):
-        if query is None:
-            rw_query = True
-        else:
-            query = query.strip()
-            rw_query = not query.startswith('SELECT ')
-            rw_query = rw_query or query.endswith(' FOR UPDATE') or ' INTO ' in query
+        backend = self._backend
+        rw_query = query is None or _is_write_query(query)
         if rw_query:
-            self._backend.primary_synced = False
-            self._backend.secondary_synced = False
-            if not self._backend.autocommit and not self._backend.in_write_transaction:
-                self._backend.in_write_transaction = True
-        primary_required = rw_query or self._backend.in_write_transaction
+            backend.primary_synced = False
+            backend.secondary_synced = False
+            if not backend.autocommit and not backend.in_write_transaction:
+                backend.in_write_transaction = True
+        primary_required = rw_query or backend.in_write_transaction
         if primary_required and not self._primary:
             self._primary = True
             self.close()
-        elif not self._backend.secondary_synced:
-            self._backend.sync_wait_secondary()
-        LOGGER.debug('%s: %s' % ('primary' if self._primary else 'secondary', query))
+        elif not backend.secondary_synced:
+            backend.sync_wait_secondary()
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug('%s: %s', 'primary' if self._primary else 'secondary', query)
         return self.cursor
 
     def callproc(self, procname, args=None):
-        self.prepare(None)
-        return self._failover_cursor('callproc')(procname, args=args)
+        cursor = self.prepare(None)
+        if not self._backend.failover_active:
+            return cursor.callproc(procname, args=args)
+        return self._failover_call('callproc', cursor.callproc, procname, args=args)
 
     def execute(self, query, args=None):
-        self.prepare(query)
-        return self._failover_cursor('execute')(query, args=args)
+        cursor = self.prepare(query)
+        if not self._backend.failover_active:
+            return cursor.execute(query, args=args)
+        return self._failover_call('execute', cursor.execute, query, args=args)
 
     def executemany(self, query, args=None):
-        self.prepare(query)
-        return self._failover_cursor('executemany')(query, args=args)
+        cursor = self.prepare(query)
+        if not self._backend.failover_active:
+            return cursor.executemany(query, args=args)
+        return self._failover_call('executemany', cursor.executemany, query, args=args)
 
     def close(self):
         if self._cursor is not None:
@@ -152,31 +269,36 @@ class CursorWrapper:
             self._cursor = None
 
     def _failover_cursor(self, item):
-        if not self._backend.failover_active:
-            return getattr(self.cursor, item)
+        backend = self._backend
+        failover_active = backend.failover_active
+        # the cursor is resolved once, the property is only needed if it does not exist yet
+        cursor = self._cursor
+        if not failover_active or item in UNRECORDED_ATTRIBUTES:
+            return getattr(self.cursor if cursor is None else cursor, item)
 
         try:
-            obj = getattr(self.cursor, item)
+            if cursor is None:
+                cursor = self.cursor
+            obj = getattr(cursor, item)
         except Exception as e:
-            self._cursor = self._backend.handle_exc(e, cursor=self._cursor)
-            obj = getattr(self._cursor, item)
+            self._cursor = cursor = backend.handle_exc(e, cursor=self._cursor)
+            obj = getattr(cursor, item)
 
-        def wrap(func):
-            def decor(*args, **kwargs):
-                try:
-                    ret = func(*args, **kwargs)
-                except Exception as exc:
-                    self._cursor = self._backend.handle_exc(exc, cursor=self._cursor)
-                    ret = getattr(self._cursor, func.__name__)(*args, **kwargs)
-                self.add_history(item, args, kwargs, ret)
-                return ret
-            return decor
         if hasattr(obj, '__call__'):
-            obj = wrap(obj)
-        else:
-            self.add_history(item, None, None, obj)
+            return functools.partial(self._failover_call, item, obj)
+        self.add_history(item, None, None, obj, failover_active=failover_active)
         return obj
 
+    def _failover_call(self, item, func, *args, **kwargs):
+        try:
+            ret = func(*args, **kwargs)
+        except Exception as exc:
+            self._cursor = self._backend.handle_exc(exc, cursor=self._cursor)
+            ret = getattr(self._cursor, item)(*args, **kwargs)
+        # the call may have changed the failover state, so it is checked again
+        self.add_history(item, args, kwargs, ret)
+        return ret
+
     def __enter__(self):
         # at this moment it is unknown if this cursor will be used for write queries, force creating a primary cursor
         self._primary = True
@@ -216,6 +338,10 @@ class DatabaseWrapper(base.DatabaseWrapper):
 
     _failover_active = None
     _failover_enable = None
+    _node_settings = None
+    _primary_node = None
+    _secondary_node = None
+    _secondary_synced_gtid = None
     _secondary_wrapper = None
 
     def __init__(self, settings_dict, alias=DEFAULT_DB_ALIAS):
@@ -224,28 +350,38 @@ class DatabaseWrapper(base.DatabaseWrapper):
         if 'OPTIONS' not in self.base_settings:
             self.base_settings['OPTIONS'] = dict()
         self.base_settings['OPTIONS'].pop('unix_socket', None)
+        # fail fast on unreachable nodes, so the next node can be tried
+        self.base_settings['OPTIONS'].setdefault('connect_timeout', 2)
         self.disable_update_can_self_select = self.base_settings['OPTIONS'].pop('disable_update_can_self_select', True)
         self.failover_enable = self.base_settings['OPTIONS'].pop('failover_enable', True)
         self.failover_history = list()
         self.failover_history_limit = self.base_settings['OPTIONS'].pop('failover_history_limit', 10000)
+        self.failover_verify_checksum = self.base_settings['OPTIONS'].pop('failover_verify_checksum', True)
+        self.node_check_interval = self.base_settings['OPTIONS'].pop('node_check_interval', 0.0)
         self.optimistic_transactions = self.base_settings['OPTIONS'].pop('optimistic_transactions', True)
         self.reconnect_wait_time = self.base_settings['OPTIONS'].pop('reconnect_wait_time', 5.0)
+        self.secondary_connect_concurrency = self.base_settings['OPTIONS'].pop('secondary_connect_concurrency', 1)
         self.wsrep_sync_after_write = self.base_settings['OPTIONS'].pop('wsrep_sync_after_write', True)
         self.wsrep_sync_timeout = self.base_settings['OPTIONS'].pop('wsrep_sync_timeout', 5)
         self.wsrep_sync_use_gtid = self.base_settings['OPTIONS'].pop('wsrep_sync_use_gtid', False)
         self._in_handle_exc = False
+        self._node_settings = dict()
         super(DatabaseWrapper, self).__init__(self.base_settings, alias=alias)
 
     def close(self):
         if self._secondary_wrapper is not None:
             self._secondary_wrapper.close()
             self._secondary_wrapper = None
+            self._secondary_node = None
+            self._secondary_synced_gtid = None
         super(DatabaseWrapper, self).close()
+        self._primary_node = None
         self.failover_history_reset()
 
     def connect(self):
         self.connection = None
         self.primary_connected = False
+        self._primary_node = None
         self.connect_to_node(primary=True)
         self.primary_connected = True
 
@@ -253,20 +389,17 @@ class DatabaseWrapper(base.DatabaseWrapper):
         if primary:
             nodes = sorted(NODE_STATE.get_online_nodes() or NODE_STATE.get_all_nodes())
         else:
-            nodes = list(NODE_STATE.get_online_nodes() or NODE_STATE.get_all_nodes())
-            random.shuffle(nodes)
+            nodes = NODE_STATE.shuffle_by_latency(NODE_STATE.get_online_nodes() or NODE_STATE.get_all_nodes())
             preferred_host = self.base_settings.get('HOST', '')
             if preferred_host:
-                if preferred_host in nodes:
-                    nodes.remove(preferred_host)
-                nodes.insert(0, preferred_host)
+                nodes = [preferred_host] + [x for x in nodes if x != preferred_host]
+        if not primary and self.secondary_connect_concurrency > 1:
+            self._secondary_wrapper = self.connect_to_secondary_nodes(nodes)
+            return
         for node in nodes:
-            LOGGER.info('connect %s to node %s' % ('primary' if primary else 'secondary', node))
-            settings_dict = copy.deepcopy(self.base_settings)
-            settings_dict['ENGINE'] = 'django.db.backends.mysql'
-            for k, v in settings_dict['NODES'].get(node, {}).items():
-                settings_dict[k] = v
-            del settings_dict['NODES']
+            LOGGER.info('connect %s to node %s', 'primary' if primary else 'secondary', node)
+            settings_dict = self.get_node_settings(node)
+            t = time.perf_counter()
             try:
                 if primary:
                     self.settings_dict = settings_dict
@@ -276,42 +409,128 @@ class DatabaseWrapper(base.DatabaseWrapper):
                     self._secondary_wrapper = base.DatabaseWrapper(settings_dict, alias=self.alias)
                     self._secondary_wrapper.connect()
                     connection = self._secondary_wrapper.connection
-                with connection.cursor() as cursor:
-                    cursor.execute(
-                        "SELECT variable_name, variable_value "
-                        "FROM information_schema.global_status "
-                        "WHERE variable_name IN ("
-                        "'WSREP_CLUSTER_STATUS', 'WSREP_LOCAL_STATE', 'WSREP_READY'"
-                        ") "
-                        "UNION "
-                        "SELECT variable_name, variable_value "
-                        "FROM information_schema.global_variables "
-                        "WHERE variable_name IN ("
-                        "'WSREP_DESYNC', 'WSREP_REJECT_QUERIES', 'WSREP_SST_DONOR_REJECTS_QUERIES'"
-                        ")"
-                    )
-                    results = {k.upper(): v.upper() for k, v in cursor.fetchall()}
-                if results['WSREP_READY'] != 'ON':
-                    raise base.Database.Error('WSREP_READY: %s' % results['WSREP_READY'])
-                if results['WSREP_CLUSTER_STATUS'] != 'PRIMARY':
-                    raise base.Database.Error('WSREP_CLUSTER_STATUS: %s' % results['WSREP_CLUSTER_STATUS'])
-                if results['WSREP_DESYNC'] != 'OFF':
-                    raise base.Database.Error('WSREP_DESYNC')
-                if results['WSREP_LOCAL_STATE'] != '4':
-                    if results['WSREP_LOCAL_STATE'] != '2':
-                        raise base.Database.Error('WSREP_LOCAL_STATE: %s' % results['WSREP_LOCAL_STATE'])
-                    elif results['WSREP_SST_DONOR_REJECTS_QUERIES'] == 'ON':
-                        raise base.Database.Error('WSREP_SST_DONOR_REJECTS_QUERIES')
-                if results['WSREP_REJECT_QUERIES'] != 'NONE':
-                    raise base.Database.Error('WSREP_REJECT_QUERIES: %s' % results['WSREP_REJECT_QUERIES'])
-                NODE_STATE.mark_online(node)
+                self.check_node_state(node, connection)
+                NODE_STATE.mark_online(node, latency=time.perf_counter() - t)
+                if primary:
+                    self._primary_node = node
+                else:
+                    self._secondary_node = node
                 break
             except base.Database.Error as e:
-                LOGGER.info(e, exc_info=True)
+                # offline nodes are expected during failovers, tracebacks are only useful when debugging
+                LOGGER.info('Node %s is offline: %s', node, e, exc_info=LOGGER.isEnabledFor(logging.DEBUG))
                 NODE_STATE.mark_offline(node)
         else:
             raise DatabaseError('No nodes available. Tried: %s' % ', '.join(nodes))
 
+    def connect_to_secondary_nodes(self, nodes):
+        # try up to secondary_connect_concurrency nodes at once and use the first one being ready
+        for x in range(0, len(nodes), self.secondary_connect_concurrency):
+            wrappers = dict()
+            for node in nodes[x:x + self.secondary_connect_concurrency]:
+                LOGGER.info('connect secondary to node %s', node)
+                wrappers[node] = base.DatabaseWrapper(self.get_node_settings(node), alias=self.alias)
+                # connections are established in worker threads and may be closed by them
+                wrappers[node].inc_thread_sharing()
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(wrappers))
+            futures = {executor.submit(self._connect_secondary_node, n, w): n for n, w in wrappers.items()}
+            executor.shutdown(wait=False)
+            ready = None
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    if future.result():
+                        ready = futures[future]
+                        break
+            finally:
+                # close every other connection once it is established, even if waiting for them failed
+                for future, node in futures.items():
+                    if node != ready:
+                        future.add_done_callback(functools.partial(self._discard_secondary_node, wrappers[node]))
+            if ready is not None:
+                wrappers[ready].dec_thread_sharing()
+                self._secondary_node = ready
+                return wrappers[ready]
+        raise DatabaseError('No nodes available. Tried: %s' % ', '.join(nodes))
+
+    def _connect_secondary_node(self, node, wrapper):
+        t = time.perf_counter()
+        try:
+            wrapper.connect()
+            self.check_node_state(node, wrapper.connection)
+        except base.Database.Error as e:
+            LOGGER.info('Node %s is offline: %s', node, e, exc_info=LOGGER.isEnabledFor(logging.DEBUG))
+            NODE_STATE.mark_offline(node)
+            # the connection may have been established before the node state check failed
+            self._discard_secondary_node(wrapper)
+            return False
+        NODE_STATE.mark_online(node, latency=time.perf_counter() - t)
+        return True
+
+    @staticmethod
+    def _discard_secondary_node(wrapper, future=None):
+        if wrapper.connection is not None:
+            try:
+                wrapper.close()
+            except base.Database.Error as e:
+                LOGGER.debug('Could not close secondary connection: %s', e, exc_info=True)
+
+    def check_node_state(self, node, connection):
+        # a node which passed the check recently is trusted for node_check_interval seconds
+        if self.node_check_interval and NODE_STATE.is_checked(node, self.node_check_interval):
+            return
+        with connection.cursor() as cursor:
+            # status variables have to be read from information_schema, global variables are read directly
+            # both result sets are returned by a single round-trip
+            cursor.execute(
+                "SELECT variable_name, variable_value "
+                "FROM information_schema.global_status "
+                "WHERE variable_name IN ("
+                "'WSREP_CLUSTER_STATUS', 'WSREP_LOCAL_STATE', 'WSREP_READY'"
+                ");"
+                "SELECT "
+                "IF(@@global.wsrep_desync, 'ON', 'OFF'), "
+                "@@global.wsrep_reject_queries, "
+                "IF(@@global.wsrep_sst_donor_rejects_queries, 'ON', 'OFF')"
+            )
+            results = {k.upper(): v.upper() for k, v in cursor.fetchall()}
+            variables = cursor.fetchone() if cursor.nextset() else None
+        # an incomplete result marks the node as offline instead of failing with an unrelated error
+        if variables is None or len(variables) != 3:
+            raise base.Database.Error('Incomplete wsrep variables: %s' % (variables,))
+        results.update(zip(
+            ('WSREP_DESYNC', 'WSREP_REJECT_QUERIES', 'WSREP_SST_DONOR_REJECTS_QUERIES'),
+            (str(v).upper() for v in variables)
+        ))
+        missing = {'WSREP_CLUSTER_STATUS', 'WSREP_LOCAL_STATE', 'WSREP_READY'}.difference(results)
+        if missing:
+            raise base.Database.Error('Missing wsrep status: %s' % ', '.join(sorted(missing)))
+        if results['WSREP_READY'] != 'ON':
+            raise base.Database.Error('WSREP_READY: %s' % results['WSREP_READY'])
+        if results['WSREP_CLUSTER_STATUS'] != 'PRIMARY':
+            raise base.Database.Error('WSREP_CLUSTER_STATUS: %s' % results['WSREP_CLUSTER_STATUS'])
+        if results['WSREP_DESYNC'] != 'OFF':
+            raise base.Database.Error('WSREP_DESYNC')
+        if results['WSREP_LOCAL_STATE'] != '4':
+            if results['WSREP_LOCAL_STATE'] != '2':
+                raise base.Database.Error('WSREP_LOCAL_STATE: %s' % results['WSREP_LOCAL_STATE'])
+            elif results['WSREP_SST_DONOR_REJECTS_QUERIES'] == 'ON':
+                raise base.Database.Error('WSREP_SST_DONOR_REJECTS_QUERIES')
+        if results['WSREP_REJECT_QUERIES'] != 'NONE':
+            raise base.Database.Error('WSREP_REJECT_QUERIES: %s' % results['WSREP_REJECT_QUERIES'])
+        NODE_STATE.mark_checked(node)
+
+    def get_node_settings(self, node):
+        node_settings = self._node_settings.get(node)
+        if node_settings is None:
+            node_settings = {k: v for k, v in self.base_settings.items() if k != 'NODES'}
+            node_settings['ENGINE'] = 'django.db.backends.mysql'
+            node_settings.update(self.base_settings['NODES'].get(node, {}))
+            self._node_settings[node] = node_settings
+        # the returned dict becomes the settings_dict of a connection, do not share it or its options
+        settings_dict = dict(node_settings)
+        settings_dict['OPTIONS'] = dict(settings_dict['OPTIONS'])
+        return settings_dict
+
     def create_cursor(self, name=None):
         if not self.primary_connected:
             return super(DatabaseWrapper, self).create_cursor(name=name)
@@ -353,12 +572,21 @@ class DatabaseWrapper(base.DatabaseWrapper):
         self.failover_history = list()
         self.failover_history_size = 0
 
+    @property
+    def secondary_is_primary(self):
+        # nodes may inherit HOST and PORT from the base settings, so the chosen nodes are compared by their keys
+        return self._primary_node is not None and self._secondary_node == self._primary_node
+
     @property
     def secondary_wrapper(self):
         if self._secondary_wrapper is None:
-            self.connect_to_node(primary=False)
+            self.connect_secondary()
         return self._secondary_wrapper
 
+    def connect_secondary(self):
+        self._secondary_synced_gtid = None
+        self.connect_to_node(primary=False)
+
     def _set_autocommit(self, autocommit):
         try:
             super(DatabaseWrapper, self)._set_autocommit(autocommit)
@@ -378,25 +606,38 @@ class DatabaseWrapper(base.DatabaseWrapper):
 
     def sync_wait_secondary(self):
         if self.wsrep_sync_after_write and not self.secondary_synced:
+            # writes are visible immediately on the node they were made on, the secondary node has to be chosen first
+            if self._secondary_wrapper is None:
+                self.connect_secondary()
+            if self.secondary_is_primary:
+                self.secondary_synced = True
+                return
             t = time.perf_counter()
+            # retries share the time of a single sync, so the first read after a write waits at most wsrep_sync_timeout
+            deadline = time.monotonic() + self.wsrep_sync_timeout
+            timeout = self.wsrep_sync_timeout
             retry = 0
+            wait = 0.0
             while not self.secondary_synced:
                 try:
                     if self.wsrep_sync_use_gtid:
-                        self._wsrep_sync_wait_upto_gtid()
+                        self._wsrep_sync_wait_upto_gtid(timeout)
                     else:
-                        self._wsrep_sync_wait()
+                        self._wsrep_sync_wait(timeout)
                 except Exception as e:
                     error_code = str(e.args[0]) if e.args else ''
-                    if retry < 3 and error_code == '1205':  # Lock wait timeout exceeded; try restarting transaction
-                        LOGGER.info('Retry syncing secondary after: %s' % str(e), exc_info=True)
+                    remaining = deadline - time.monotonic()
+                    # lock_wait_timeout is set in whole seconds, so a retry needs at least one second left
+                    if retry < 3 and error_code == '1205' and remaining > 1:  # Lock wait timeout exceeded
+                        LOGGER.info('Retry syncing secondary after: %s', e, exc_info=LOGGER.isEnabledFor(logging.DEBUG))
+                        wait = _backoff_sleep(wait, cap=remaining - 1)
+                        timeout = max(1, int(deadline - time.monotonic()))
                         retry += 1
                         continue
-                    LOGGER.warning('Error while syncing secondary: %s' % str(e), exc_info=True)
-                finally:
-                    self.secondary_synced = True
+                    LOGGER.warning('Error while syncing secondary: %s', e, exc_info=True)
+                self.secondary_synced = True
             t = time.perf_counter() - t
-            LOGGER.debug('Secondary synced in %f seconds' % t)
+            LOGGER.debug('Secondary synced in %f seconds', t)
 
     def handle_exc(self, exc, cursor=None):
         if self._in_handle_exc or not exc.args:
@@ -421,7 +662,8 @@ class DatabaseWrapper(base.DatabaseWrapper):
                 in_write_transaction = self.in_write_transaction
                 needs_rollback = self.needs_rollback
                 savepoint_ids = self.savepoint_ids
-                history = copy.deepcopy(self.failover_history)
+                # close() and connect() replace the history with a new list, so the current one can be kept as is
+                history = self.failover_history
                 history_size = self.failover_history_size
 
                 # try to gracefully close the original cursor and connection even if it will most certainly fail
@@ -429,17 +671,17 @@ class DatabaseWrapper(base.DatabaseWrapper):
                     if cursor is not None:
                         cursor.close()
                 except Exception as e:
-                    LOGGER.debug('Could not close cursor after error: ' + str(e), exc_info=True)
+                    LOGGER.debug('Could not close cursor after error: %s', e, exc_info=True)
                 try:
                     self.connection.rollback()
                 except Exception as e:
-                    LOGGER.debug('Could not rollback connection after error: ' + str(e), exc_info=True)
+                    LOGGER.debug('Could not rollback connection after error: %s', e, exc_info=True)
                 try:
                     self.close()
                 except Exception as e:
-                    LOGGER.debug('Could not close connection after error: ' + str(e), exc_info=True)
+                    LOGGER.debug('Could not close connection after error: %s', e, exc_info=True)
 
-                LOGGER.warning('Replaying %d cursors from failover history after %s' % (len(history), str(exc)))
+                LOGGER.warning('Replaying %d cursors from failover history after %s', len(history), exc)
 
                 if error_code in (
                     '1180',  # Got error 6 "No such device or address" during COMMIT
@@ -447,6 +689,9 @@ class DatabaseWrapper(base.DatabaseWrapper):
                     '2013',  # Lost connection to MySQL server during query
                 ):
                     time.sleep(self.reconnect_wait_time)
+                elif error_code in ('1205', '1213'):
+                    # do not run into the same lock again right away
+                    _backoff_sleep()
 
                 self.connect()
                 self.connection.autocommit(False)
@@ -466,7 +711,7 @@ class DatabaseWrapper(base.DatabaseWrapper):
                 self.in_atomic_block = in_atomic_block
                 self.in_write_transaction = in_write_transaction
                 self.savepoint_ids = savepoint_ids
-                self.failover_history = copy.deepcopy(history)
+                self.failover_history = history
                 self.failover_history_size = history_size
                 self._in_handle_exc = False
                 return cursor
@@ -482,7 +727,7 @@ class DatabaseWrapper(base.DatabaseWrapper):
                     result = attr
                 else:
                     result = attr(*args, **kwargs)
-                if check != hashlib.sha1(pprint.pformat(result).encode()).hexdigest():
+                if check is not None and check != _checksum(result):
                     raise DatabaseError('Replay checksum does not match')
 
             # do not close the cursor if this is the last history entry
@@ -494,32 +739,27 @@ class DatabaseWrapper(base.DatabaseWrapper):
         # return a new cursor if history is empty
         return self.connection.cursor()
 
-    def _wsrep_sync_wait(self):
+    def _wsrep_sync_wait(self, timeout):
         with self.secondary_wrapper.connection.cursor() as cursor:
+            # the variables only apply to this statement, so the session values do not need to be restored
             cursor.execute(
-                'SET @lock_wait_timeout_orig = @@lock_wait_timeout;'
-                'SET @wsrep_sync_wait_orig = @@wsrep_sync_wait;'
-                'SET SESSION lock_wait_timeout = %s;'
-                'SET SESSION wsrep_sync_wait = 1;'
-                'SELECT 1;'
-                'SET SESSION lock_wait_timeout = @lock_wait_timeout_orig;'
-                'SET SESSION wsrep_sync_wait = @wsrep_sync_wait_orig;',
-                (self.wsrep_sync_timeout,)
+                'SET STATEMENT lock_wait_timeout = %s, wsrep_sync_wait = 1 FOR SELECT 1',
+                (timeout,)
             )
 
-    def _wsrep_sync_wait_upto_gtid(self):
+    def _wsrep_sync_wait_upto_gtid(self, timeout):
         with self.connection.cursor() as primary_cursor:
             primary_cursor.execute('SELECT WSREP_LAST_WRITTEN_GTID()')
             result = primary_cursor.fetchone()
             primary_gtid = result[0].decode('utf-8')
-        if primary_gtid.endswith('-0'):
+        # the secondary has already applied this gtid if nothing was written since the last sync
+        if primary_gtid.endswith('-0') or primary_gtid == self._secondary_synced_gtid:
             return
         with self.secondary_wrapper.connection.cursor() as secondary_cursor:
+            # the variable only applies to this statement, so the session value does not need to be restored
             secondary_cursor.execute(
-                'SET @lock_wait_timeout_orig = @@lock_wait_timeout;'
-                'SET SESSION lock_wait_timeout = %s;'
-                'SELECT WSREP_SYNC_WAIT_UPTO_GTID(%s);'
-                'SET SESSION lock_wait_timeout = @lock_wait_timeout_orig;',
-                (self.wsrep_sync_timeout, primary_gtid,)
+                'SET STATEMENT lock_wait_timeout = %s FOR SELECT WSREP_SYNC_WAIT_UPTO_GTID(%s)',
+                (timeout, primary_gtid,)
             )
-            LOGGER.debug('Secondary sync upto %s' % primary_gtid)
+            LOGGER.debug('Secondary sync upto %s', primary_gtid)
+        self._secondary_synced_gtid = primary_gtid
@@ -1,11 +1,10 @@
 import warnings
 
+from django.utils.deprecation import MiddlewareMixin
 
-class GaleraMiddleware(object):
+
+class GaleraMiddleware(MiddlewareMixin):
     def __init__(self, get_response):
         warnings.warn('GaleraMiddleware is deprecated and can be removed '
                       'since deadlocks are now handled by the database backend')
-        self.get_response = get_response
-
-    def __call__(self, request):
-        return self.get_response(request)
+        super(GaleraMiddleware, self).__init__(get_response)
@@ -1,3 +1,4 @@
+import threading
 from unittest import mock
 
 from django import db
@@ -6,11 +7,21 @@ from django.test import SimpleTestCase
 
 from galera.backends.readwritesplit import base as backend
 
+# server variables read by django when connecting
+SERVER_DATA = ('10.6.12-MariaDB', '', 'InnoDB', 0, 0, 1)
+# status and global variables of a synced galera node
+WSREP_STATUS = (('wsrep_cluster_status', 'Primary'), ('wsrep_local_state', '4'), ('wsrep_ready', 'ON'))
+WSREP_VARIABLES = ('OFF', 'NONE', 'OFF')
+
 
 class ReadWriteSplitBackendTestCase(SimpleTestCase):
-    def setUp(self):
-        backend.NODE_STATE = backend.NodeState(dict())
-        self.connection = db.ConnectionHandler(settings={
+    @classmethod
+    def setUpClass(cls):
+        super(ReadWriteSplitBackendTestCase, cls).setUpClass()
+        # connection to an online node, shared by all tests and reset in setUp
+        cls.online_mock = mock.MagicMock()
+        # the settings are prepared once, every test creates its own connection from them
+        cls.handler = db.ConnectionHandler(settings={
             db.DEFAULT_DB_ALIAS: {
                 'ENGINE': 'galera.backends.readwritesplit',
                 'NODES': {
@@ -18,12 +29,50 @@ class ReadWriteSplitBackendTestCase(SimpleTestCase):
                     'db2': {},
                 }
             }
-        })[db.DEFAULT_DB_ALIAS]
+        })
+
+    def setUp(self):
+        self.online_mock.reset_mock(return_value=True, side_effect=True)
+        self._wire_online(self.online_mock)
+        connect_patch = mock.patch.object(base.Database, 'connect')
+        self.mock_connect = connect_patch.start()
+        self.addCleanup(connect_patch.stop)
+        backend.NODE_STATE = backend.NodeState(dict())
+        self.connection = self.handler.create_connection(db.DEFAULT_DB_ALIAS)
+
+    @staticmethod
+    def _wire_online(connection):
+        cursor = connection.cursor.return_value
+        cursor.__enter__.return_value = cursor
+        cursor.fetchall.return_value = WSREP_STATUS
+
+        def fetchone():
+            # answer the last query like a synced node would, regardless of how often django reads the server data
+            query = cursor.execute.call_args[0][0]
+            return SERVER_DATA if 'VERSION()' in query else WSREP_VARIABLES
 
-    @mock.patch('django.db.backends.mysql.base.Database.connect')
-    def test_primary_online_none(self, mock_connect):
+        cursor.fetchone.side_effect = fetchone
+        return connection
+
+    @staticmethod
+    def _create_connection(nodes=None, **settings):
+        settings_dict = {
+            'ENGINE': 'galera.backends.readwritesplit',
+            'NODES': nodes or {'db1': {}, 'db2': {}},
+        }
+        settings_dict.update(settings)
+        handler = db.ConnectionHandler(settings={db.DEFAULT_DB_ALIAS: settings_dict})
+        return handler.create_connection(db.DEFAULT_DB_ALIAS)
+
+    def _create_concurrent_connection(self):
+        return self._create_connection(
+            nodes={'db1': {'HOST': 'db1'}, 'db2': {'HOST': 'db2'}},
+            OPTIONS={'secondary_connect_concurrency': 2},
+        )
+
+    def test_primary_online_none(self):
         """Ensure DatabaseError is raised when no primary node is online"""
-        mock_connect.side_effect = base.Database.Error()
+        self.mock_connect.side_effect = base.Database.Error()
 
         # connection should fail on all nodes
         with self.assertRaises(db.DatabaseError):
@@ -31,52 +80,44 @@ class ReadWriteSplitBackendTestCase(SimpleTestCase):
 
         # no node should be marked online
         self.assertEqual(len(backend.NODE_STATE.nodes), 2)
-        self.assertEqual(len(list(backend.NODE_STATE.get_online_nodes())), 0)
+        self.assertEqual(backend.NODE_STATE.count_online(), 0)
 
-    @mock.patch('django.db.backends.mysql.base.Database.connect')
-    def test_primary_online_any(self, mock_connect):
+    def test_primary_online_any(self):
         """Ensure a connection can be established when any primary node is online"""
-        online_mock = mock.MagicMock()
-        cursor = online_mock.cursor.return_value
-        # simulate status variable wsrep_ready = ON
-        cursor.fetchone.side_effect = [mock.MagicMock(), ('ON',)]
-        mock_connect.side_effect = [base.Database.Error(), online_mock]
+        self.mock_connect.side_effect = [base.Database.Error(), self.online_mock]
 
         # connection to atleast one node should succeed
         self.connection.connect()
 
         # one node should be marked online
         self.assertEqual(len(backend.NODE_STATE.nodes), 2)
-        self.assertEqual(len(list(backend.NODE_STATE.get_online_nodes())), 1)
+        self.assertEqual(backend.NODE_STATE.count_online(), 1)
 
-    @mock.patch('django.db.backends.mysql.base.Database.connect')
-    def test_primary_online_after_offline(self, mock_connect):
+    def test_primary_online_after_offline(self):
         """Ensure a connection to a primary peer is successful after it has been marked offline"""
-        online_mock = mock.MagicMock()
-        cursor = online_mock.cursor.return_value
-        # simulate status variable wsrep_ready = ON
-        cursor.fetchone.side_effect = [mock.MagicMock(), ('ON',), ('ON',)]
-        mock_connect.side_effect = [base.Database.Error(), online_mock, online_mock]
+        self.mock_connect.side_effect = [base.Database.Error(), self.online_mock, self.online_mock]
 
         # connection should still succeed if one node is online
         self.connection.connect()
+        self.assertEqual(self.connection._primary_node, 'db2')
 
         # and one node should be marked online
         self.assertEqual(len(backend.NODE_STATE.nodes), 2)
-        self.assertEqual(len(list(backend.NODE_STATE.get_online_nodes())), 1)
+        self.assertEqual(backend.NODE_STATE.count_online(), 1)
 
-        # retry connecting to the first node
+        # retry connecting to the first node, the cached online nodes would still exclude it
         backend.NODE_STATE.RETRY_INTERVAL = 0
+        backend.NODE_STATE.CACHE_TTL = 0
         self.connection.connect()
+        self.assertEqual(self.connection._primary_node, 'db1')
 
         # all nodes should be marked online
         self.assertEqual(len(backend.NODE_STATE.nodes), 2)
-        self.assertEqual(len(list(backend.NODE_STATE.get_online_nodes())), 2)
+        self.assertEqual(backend.NODE_STATE.count_online(), 2)
 
-    @mock.patch('django.db.backends.mysql.base.Database.connect')
-    def test_secondary_nodes_online_none(self, mock_connect):
+    def test_secondary_nodes_online_none(self):
         """Ensure DatabaseError is raised when no secondary node is online"""
-        mock_connect.side_effect = base.Database.Error()
+        self.mock_connect.side_effect = base.Database.Error()
 
         # connection should fail on all nodes
         with self.assertRaises(db.DatabaseError):
@@ -84,44 +125,328 @@ class ReadWriteSplitBackendTestCase(SimpleTestCase):
 
         # no node should be marked online
         self.assertEqual(len(backend.NODE_STATE.nodes), 2)
-        self.assertEqual(len(list(backend.NODE_STATE.get_online_nodes())), 0)
+        self.assertEqual(backend.NODE_STATE.count_online(), 0)
 
-    @mock.patch('django.db.backends.mysql.base.Database.connect')
-    def test_secondary_nodes_online_any(self, mock_connect):
+    def test_secondary_nodes_online_any(self):
         """Ensure a connection can be established when any secondary node is online"""
-        online_mock = mock.MagicMock()
-        cursor = online_mock.cursor.return_value
-        # simulate status variable wsrep_ready = ON
-        cursor.fetchone.side_effect = [mock.MagicMock(), ('ON',)]
-        mock_connect.side_effect = [base.Database.Error(), online_mock]
+        self.mock_connect.side_effect = [base.Database.Error(), self.online_mock]
 
         # connection to atleast one node should succeed
         self.connection.secondary_wrapper.ensure_connection()
 
         # one node should be marked online
         self.assertEqual(len(backend.NODE_STATE.nodes), 2)
-        self.assertEqual(len(list(backend.NODE_STATE.get_online_nodes())), 1)
+        self.assertEqual(backend.NODE_STATE.count_online(), 1)
 
-    @mock.patch('django.db.backends.mysql.base.Database.connect')
-    def test_secondary_nodes_online_after_offline(self, mock_connect):
+    def test_secondary_nodes_online_after_offline(self):
         """Ensure a connection to a secondary peer is successful after it has been marked offline"""
-        online_mock = mock.MagicMock()
-        cursor = online_mock.cursor.return_value
-        # simulate status variable wsrep_ready = ON
-        cursor.fetchone.side_effect = [mock.MagicMock(), ('ON',), ('ON',)]
-        mock_connect.side_effect = [base.Database.Error(), online_mock, online_mock]
+        self.mock_connect.side_effect = [base.Database.Error(), self.online_mock, self.online_mock]
+        # the preferred host is tried first, which makes the order of the secondary nodes predictable
+        self.connection = self._create_connection(HOST='db1')
 
         # connection should still succeed if one node is online
         self.connection.secondary_wrapper.ensure_connection()
+        self.assertEqual(self.connection._secondary_node, 'db2')
 
         # and one node should be marked online
         self.assertEqual(len(backend.NODE_STATE.nodes), 2)
-        self.assertEqual(len(list(backend.NODE_STATE.get_online_nodes())), 1)
+        self.assertEqual(backend.NODE_STATE.count_online(), 1)
 
-        # retry connecting to the first node
+        # retry connecting to the first node, the cached online nodes would still exclude it
         backend.NODE_STATE.RETRY_INTERVAL = 0
+        backend.NODE_STATE.CACHE_TTL = 0
+        self.connection.close()
         self.connection.secondary_wrapper.ensure_connection()
+        self.assertEqual(self.connection._secondary_node, 'db1')
 
         # all nodes should be marked online
         self.assertEqual(len(backend.NODE_STATE.nodes), 2)
-        self.assertEqual(len(list(backend.NODE_STATE.get_online_nodes())), 2)
+        self.assertEqual(backend.NODE_STATE.count_online(), 2)
+
+    def test_secondary_concurrent_first_ready(self):
+        """Ensure the first ready secondary node is used and the slower connection is closed"""
+        db1, db2 = self._wire_online(mock.MagicMock()), self._wire_online(mock.MagicMock())
+        release, closed = threading.Event(), threading.Event()
+        db2.close.side_effect = closed.set
+
+        def connect(**kwargs):
+            if kwargs['host'] == 'db2':
+                # db2 becomes ready after db1 has been chosen
+                release.wait(5)
+                return db2
+            return db1
+
+        self.mock_connect.side_effect = connect
+        connection = self._create_concurrent_connection()
+        self.assertIs(connection.secondary_wrapper.connection, db1)
+
+        # the slower connection should be closed as soon as it is established
+        release.set()
+        self.assertTrue(closed.wait(5))
+        db1.close.assert_not_called()
+
+    def test_secondary_concurrent_node_state_failed(self):
+        """Ensure a connection to a secondary node failing the node state check is closed"""
+        db1, db2 = self._wire_online(mock.MagicMock()), self._wire_online(mock.MagicMock())
+        db1.cursor.return_value.fetchall.return_value = (('wsrep_ready', 'OFF'),)
+        closed = threading.Event()
+        db1.close.side_effect = closed.set
+        closed_before_ready = []
+
+        def connect(**kwargs):
+            if kwargs['host'] == 'db2':
+                # db1 should be closed by its own connection attempt, without waiting for a winner
+                closed_before_ready.append(closed.wait(5))
+                return db2
+            return db1
+
+        self.mock_connect.side_effect = connect
+        connection = self._create_concurrent_connection()
+        self.assertIs(connection.secondary_wrapper.connection, db2)
+        self.assertEqual(closed_before_ready, [True])
+        db1.close.assert_called_once_with()
+        self.assertEqual(backend.NODE_STATE.get_online_nodes(), ('db2',))
+
+    def test_secondary_concurrent_unexpected_error(self):
+        """Ensure established secondary connections are closed when another connection attempt fails unexpectedly"""
+        db2 = self._wire_online(mock.MagicMock())
+        release, closed = threading.Event(), threading.Event()
+        db2.close.side_effect = closed.set
+
+        def connect(**kwargs):
+            if kwargs['host'] == 'db2':
+                release.wait(5)
+                return db2
+            raise RuntimeError()
+
+        self.mock_connect.side_effect = connect
+        connection = self._create_concurrent_connection()
+        with self.assertRaises(RuntimeError):
+            connection.secondary_wrapper
+
+        release.set()
+        self.assertTrue(closed.wait(5))
+
+    def test_secondary_concurrent_online_none(self):
+        """Ensure DatabaseError is raised when no secondary node is online while connecting concurrently"""
+        self.mock_connect.side_effect = base.Database.Error()
+
+        connection = self._create_concurrent_connection()
+        with self.assertRaises(db.DatabaseError):
+            connection.secondary_wrapper
+
+        self.assertEqual(backend.NODE_STATE.count_online(), 0)
+
+    def test_secondary_is_primary(self):
+        """Ensure the secondary is only considered the primary if both are connected to the same node"""
+        self.mock_connect.return_value = self.online_mock
+        # the nodes inherit the host, which also makes it the preferred secondary node
+        for host, secondary_is_primary in (('db1', True), ('db2', False)):
+            with self.subTest(host=host):
+                connection = self._create_connection(HOST=host)
+                connection.connect()
+                connect_count = self.mock_connect.call_count
+
+                # reading the property does not connect the secondary node
+                self.assertFalse(connection.secondary_is_primary)
+                self.assertEqual(self.mock_connect.call_count, connect_count)
+
+                connection.connect_secondary()
+                self.assertEqual(connection.secondary_is_primary, secondary_is_primary)
+
+    def test_sync_wait_secondary_same_node(self):
+        """Ensure the secondary node is connected before syncing and not synced if it is the primary node"""
+        self.mock_connect.return_value = self.online_mock
+        connection = self._create_connection(HOST='db1')
+        connection.connect()
+        connection.secondary_synced = False
+
+        with mock.patch.object(connection, '_wsrep_sync_wait') as sync:
+            connection.sync_wait_secondary()
+
+        self.assertEqual(connection._secondary_node, 'db1')
+        sync.assert_not_called()
+        self.assertTrue(connection.secondary_synced)
+
+    def test_check_node_state(self):
+        """Ensure the node state is read from both result sets of a single query"""
+        node = self._wire_online(mock.MagicMock())
+        cursor = node.cursor.return_value
+
+        self.connection.check_node_state('db1', node)
+
+        cursor.execute.assert_called_once()
+        cursor.nextset.assert_called_once_with()
+        self.assertTrue(backend.NODE_STATE.is_checked('db1', 60))
+
+    def test_check_node_state_failed(self):
+        """Ensure a node is rejected if it is not synced or its state can not be read completely"""
+        for name, status, variables, nextset in (
+                ('desynced', WSREP_STATUS, ('ON', 'NONE', 'OFF'), True),
+                ('rejecting queries', WSREP_STATUS, ('OFF', 'ALL', 'OFF'), True),
+                ('missing status', WSREP_STATUS[:2], WSREP_VARIABLES, True),
+                ('missing variables', WSREP_STATUS, None, True),
+                ('short variables', WSREP_STATUS, ('OFF', 'NONE'), True),
+                ('missing result set', WSREP_STATUS, WSREP_VARIABLES, None),
+        ):
+            with self.subTest(name):
+                node = self._wire_online(mock.MagicMock())
+                cursor = node.cursor.return_value
+                cursor.fetchall.return_value = status
+                cursor.fetchone.side_effect = None
+                cursor.fetchone.return_value = variables
+                cursor.nextset.return_value = nextset
+
+                with self.assertRaises(base.Database.Error):
+                    self.connection.check_node_state('db1', node)
+                self.assertFalse(backend.NODE_STATE.is_checked('db1', 60))
+
+    def test_is_write_query(self):
+        """Ensure queries are classified and only short selects are cached"""
+        backend._is_write_select_cached.cache_clear()
+        self.assertTrue(backend._is_write_query('INSERT INTO `t` (`a`) VALUES (%s)'))
+        self.assertTrue(backend._is_write_query('SELECT 1 FOR UPDATE'))
+        self.assertTrue(backend._is_write_query('SELECT 1 INTO @x'))
+        self.assertFalse(backend._is_write_query(' SELECT 1 '))
+        self.assertFalse(backend._is_write_query('SELECT ' + 'x' * backend.SELECT_CACHE_MAX_LENGTH))
+        self.assertEqual(backend._is_write_select_cached.cache_info().currsize, 3)
+
+    def _replay_changed_result(self, connection):
+        # record a query and replay it on a connection returning a different result
+        cursor = backend.CursorWrapper(connection)
+        cursor.add_history('execute', ('SELECT 1',), {}, 1, failover_active=True)
+        cursor.add_history('fetchone', (), {}, (1,), failover_active=True)
+        connection.connection = mock.MagicMock()
+        connection.connection.cursor.return_value.execute.return_value = 1
+        connection.connection.cursor.return_value.fetchone.return_value = (2,)
+        return connection.replay_history(connection.failover_history)
+
+    def test_replay_checksum_mismatch(self):
+        """Ensure a replayed result differing from the original result is detected by default"""
+        with self.assertRaises(db.DatabaseError):
+            self._replay_changed_result(self._create_connection())
+
+    def test_replay_checksum_disabled(self):
+        """Ensure replayed results are not verified if failover_verify_checksum is disabled"""
+        connection = self._create_connection(OPTIONS={'failover_verify_checksum': False})
+        cursor = self._replay_changed_result(connection)
+        cursor.fetchone.assert_called_once_with()
+
+    @mock.patch.object(backend, '_backoff_sleep', return_value=0.01)
+    @mock.patch.object(backend.DatabaseWrapper, 'secondary_is_primary', new_callable=mock.PropertyMock)
+    def test_sync_wait_secondary_retry(self, mock_secondary_is_primary, mock_backoff_sleep):
+        """Ensure syncing the secondary is retried after a lock wait timeout"""
+        mock_secondary_is_primary.return_value = False
+        lock_wait_timeout = base.Database.OperationalError(1205, 'Lock wait timeout exceeded')
+        self.connection._secondary_wrapper = mock.MagicMock()
+        self.connection.secondary_synced = False
+
+        # the first attempt fails after 1.5 seconds, the retry gets the remaining time in whole seconds
+        with mock.patch.object(backend.time, 'monotonic', side_effect=[100.0, 101.5, 101.6]), \
+                mock.patch.object(self.connection, '_wsrep_sync_wait', side_effect=[lock_wait_timeout, None]) as sync:
+            self.connection.sync_wait_secondary()
+
+        self.assertEqual(sync.call_args_list, [mock.call(5), mock.call(3)])
+        mock_backoff_sleep.assert_called_once_with(0.0, cap=2.5)
+        self.assertTrue(self.connection.secondary_synced)
+
+    @mock.patch.object(backend, '_backoff_sleep', return_value=0.01)
+    @mock.patch.object(backend.DatabaseWrapper, 'secondary_is_primary', new_callable=mock.PropertyMock)
+    def test_sync_wait_secondary_retry_timeout(self, mock_secondary_is_primary, mock_backoff_sleep):
+        """Ensure syncing the secondary is not retried once wsrep_sync_timeout is used up"""
+        mock_secondary_is_primary.return_value = False
+        lock_wait_timeout = base.Database.OperationalError(1205, 'Lock wait timeout exceeded')
+        self.connection._secondary_wrapper = mock.MagicMock()
+        self.connection.secondary_synced = False
+
+        # less than a second is left after the first attempt
+        with mock.patch.object(backend.time, 'monotonic', side_effect=[100.0, 104.5]), \
+                mock.patch.object(self.connection, '_wsrep_sync_wait', side_effect=lock_wait_timeout) as sync:
+            self.connection.sync_wait_secondary()
+
+        self.assertEqual(sync.call_count, 1)
+        mock_backoff_sleep.assert_not_called()
+        self.assertTrue(self.connection.secondary_synced)
+
+    @mock.patch.object(backend, '_backoff_sleep', return_value=0.01)
+    @mock.patch.object(backend.DatabaseWrapper, 'secondary_is_primary', new_callable=mock.PropertyMock)
+    def test_sync_wait_secondary_retry_limit(self, mock_secondary_is_primary, mock_backoff_sleep):
+        """Ensure syncing the secondary is given up after three retries"""
+        mock_secondary_is_primary.return_value = False
+        lock_wait_timeout = base.Database.OperationalError(1205, 'Lock wait timeout exceeded')
+        self.connection._secondary_wrapper = mock.MagicMock()
+        self.connection.secondary_synced = False
+
+        with mock.patch.object(self.connection, '_wsrep_sync_wait', side_effect=lock_wait_timeout) as sync:
+            self.connection.sync_wait_secondary()
+
+        self.assertEqual(sync.call_count, 4)
+        self.assertEqual(mock_backoff_sleep.call_count, 3)
+        self.assertTrue(self.connection.secondary_synced)
+
+    @mock.patch.object(backend.DatabaseWrapper, 'secondary_is_primary', new_callable=mock.PropertyMock)
+    def test_sync_wait_secondary_gtid(self, mock_secondary_is_primary):
+        """Ensure syncing upto a gtid is skipped only if the secondary has already waited for it"""
+        mock_secondary_is_primary.return_value = False
+        connection = self._create_connection(OPTIONS={'wsrep_sync_use_gtid': True})
+        primary = mock.MagicMock()
+        primary_cursor = primary.cursor.return_value.__enter__.return_value
+        primary_cursor.fetchone.return_value = (b'0-1-5',)
+        connection.connection = primary
+        connection._secondary_wrapper = mock.MagicMock()
+
+        def sync():
+            # a write on the primary requires the secondary to be synced again
+            connection.secondary_synced = False
+            connection.sync_wait_secondary()
+            return connection._secondary_wrapper.connection.cursor.return_value.__enter__.return_value.execute
+
+        self.assertEqual(sync().call_count, 1)
+        # nothing has been written since the last sync
+        self.assertEqual(sync().call_count, 1)
+        # a new write advances the gtid
+        primary_cursor.fetchone.return_value = (b'0-1-6',)
+        self.assertEqual(sync().call_count, 2)
+
+        # a new secondary connection has not waited for any gtid yet
+        connection.close()
+        connection.connection = primary
+        connection._secondary_wrapper = mock.MagicMock()
+        self.assertEqual(sync().call_count, 1)
+
+
+class NodeStateTestCase(SimpleTestCase):
+    def setUp(self):
+        self.node_state = backend.NodeState(dict())
+        self.node_state.add_nodes(('db1', 'db2'))
+
+    def test_online_nodes_cache_invalidated(self):
+        """Ensure cached online nodes are invalidated when a node changes its state"""
+        self.assertEqual(self.node_state.get_online_nodes(), ('db1', 'db2'))
+
+        self.node_state.mark_offline('db1')
+        self.assertEqual(self.node_state.get_online_nodes(), ('db2',))
+        self.assertEqual(self.node_state.count_online(), 1)
+
+        self.node_state.mark_online('db1')
+        self.assertEqual(self.node_state.get_online_nodes(), ('db1', 'db2'))
+
+    def test_latency_moving_average(self):
+        """Ensure node latencies are averaged and unmeasured nodes are preferred"""
+        self.node_state.mark_online('db1', latency=1.0)
+        self.assertEqual(self.node_state.latencies['db1'], 1.0)
+        self.node_state.mark_online('db1', latency=2.0)
+        self.assertEqual(self.node_state.latencies['db1'], 1.125)
+
+        # an unmeasured node gets a much higher weight than a slow one
+        order = [self.node_state.shuffle_by_latency(('db1', 'db2'))[0] for x in range(100)]
+        self.assertGreater(order.count('db2'), 50)
+
+    def test_checked_nodes(self):
+        """Ensure a node is only considered checked within the interval and until it goes offline"""
+        self.assertFalse(self.node_state.is_checked('db1', 60))
+        self.node_state.mark_checked('db1')
+        self.assertTrue(self.node_state.is_checked('db1', 60))
+        self.assertFalse(self.node_state.is_checked('db1', 0))
+        self.node_state.mark_offline('db1')
+        self.assertFalse(self.node_state.is_checked('db1', 60))